@@ -9,58 +9,40 @@ CSRF tests
 """
 
 from contextlib import contextmanager
-from datetime import date, timedelta
+import time
 
 import flask_wtf.csrf
 
 import pytest
 from flask_wtf import CSRFProtect
-from freezegun import freeze_time
 from flask import render_template_string
+from itsdangerous import TimestampSigner
 
 from flask_security import Security, auth_required
 from tests.test_utils import get_form_input_value, get_session, logout
 
 
-REAL_VALIDATE_CSRF = None
-
-
 @contextmanager
 def mp_validate_csrf():
     """Make sure we are really calling CSRF validation and getting correct answer"""
     orig_validate_csrf = flask_wtf.csrf.validate_csrf
-    try:
-        mp = MpValidateCsrf(orig_validate_csrf)
-        flask_wtf.csrf.validate_csrf = mp.mp_validate_csrf
-        yield mp
-    finally:
-        flask_wtf.csrf.validate_csrf = orig_validate_csrf
-
-
-class MpValidateCsrf:
-    success = 0
-    failure = 0
 
-    def __init__(self, real_validate_csrf):
-        MpValidateCsrf.success = 0
-        MpValidateCsrf.failure = 0
-        global REAL_VALIDATE_CSRF
-        REAL_VALIDATE_CSRF = real_validate_csrf
-
-    @staticmethod
-    def mp_validate_csrf(data, secret_key=None, time_limit=None, token_key=None):
+    def mp(data, secret_key=None, time_limit=None, token_key=None):
         try:
-            REAL_VALIDATE_CSRF(data, secret_key, time_limit, token_key)
-            MpValidateCsrf.success += 1
+            orig_validate_csrf(data, secret_key, time_limit, token_key)
+            mp.success += 1
         except Exception:
-            MpValidateCsrf.failure += 1
+            mp.failure += 1
             raise
 
+    mp.success = mp.failure = 0
+    with pytest.MonkeyPatch.context() as m:
+        m.setattr(flask_wtf.csrf, "validate_csrf", mp)
+        yield mp
+
 
 def _get_csrf_token(client):
-    response = client.get(
-        "/login", data={}, headers={"Content-Type": "application/json"}
-    )
+    response = client.get("/login", headers={"Accept": "application/json"})
     return response.json["response"]["csrf_token"]
 
 
@@ -84,7 +66,6 @@ def json_login(
 
     response = client.post(
         endpoint or "/login?include_auth_token",
-        content_type="application/json",
         json=data,
         headers=headers,
     )
@@ -94,12 +75,19 @@ def json_login(
 
 
 def json_logout(client):
-    response = client.post("logout", content_type="application/json", data={})
+    response = client.post("logout", content_type="application/json")
     assert response.status_code == 200
     assert response.json["meta"]["code"] == 200
     return response
 
 
+@pytest.fixture()
+def logged_in_client(client):
+    # Return client with matt logged in via JSON (CSRF token sent as a header).
+    json_login(client, use_header=True)
+    return client
+
+
 @pytest.mark.csrf()
 def test_login_csrf(app, client):
     # This shouldn't log in - but return login form with csrf token.
@@ -118,10 +106,9 @@ def test_login_csrf(app, client):
     assert b"Log in" in response.data
 
 
+@pytest.mark.app_settings(wtf_csrf_enabled=True)
 def test_login_csrf_double(app, client):
     # Test if POST login while already logged in - just redirects to POST_LOGIN
-    app.config["WTF_CSRF_ENABLED"] = True
-
     # This shouldn't log in - but return login form with csrf token.
     data = dict(email="matt@lp.com", password="password", remember="y")
     response = client.post("/login", data=data)
@@ -129,9 +116,9 @@ def test_login_csrf_double(app, client):
     assert b"csrf_token" in response.data
 
     data["csrf_token"] = _get_csrf_token(client)
-    response = client.post("/login", data=data, follow_redirects=True)
-    assert response.status_code == 200
-    assert b"Welcome matt" in response.data
+    response = client.post("/login", data=data)
+    assert response.status_code == 302
+    assert response.location == "/"
 
     data["csrf_token"] = _get_csrf_token(client)
     # Note - should redirect to POST_LOGIN with current user ignoring form data.
@@ -166,9 +153,8 @@ def test_login_csrf_json_header(app, client):
 
 
 @pytest.mark.settings(csrf_ignore_unauth_endpoints=True)
+@pytest.mark.app_settings(wtf_csrf_enabled=True)
 def test_login_csrf_unauth_ok(app, client):
-    app.config["WTF_CSRF_ENABLED"] = True
-
     with mp_validate_csrf() as mp:
         # This should log in.
         data = dict(email="matt@lp.com", password="password", remember="y")
@@ -180,18 +166,18 @@ def test_login_csrf_unauth_ok(app, client):
 
 
 @pytest.mark.settings(csrf_ignore_unauth_endpoints=True)
+@pytest.mark.app_settings(wtf_csrf_enabled=True)
 def test_login_csrf_unauth_double(app, client, get_message):
     # Test double login w/o CSRF returns unauth required error message.
-    app.config["WTF_CSRF_ENABLED"] = True
 
     # This should log in.
     data = dict(email="matt@lp.com", password="password", remember="y")
-    response = client.post("/login", data=data, follow_redirects=True)
-    assert response.status_code == 200
-    assert b"Welcome matt" in response.data
+    response = client.post("/login", data=data)
+    assert response.status_code == 302
+    assert response.location == "/"
 
     # login in again - should work
-    response = client.post("/login", content_type="application/json", json=data)
+    response = client.post("/login", json=data)
     assert response.status_code == 400
     assert response.json["response"]["errors"][0].encode("utf-8") == get_message(
         "ANONYMOUS_USER_REQUIRED"
@@ -208,7 +194,7 @@ def test_reset(app, client):
     with mp_validate_csrf() as mp:
         data = dict(email="matt@lp.com")
         # should fail - no CSRF token - should get a JSON response
-        response = client.post("/reset", content_type="application/json", json=data)
+        response = client.post("/reset", json=data)
         assert response.status_code == 400
         assert response.json["response"]["errors"][0] == "The CSRF token is missing."
         # test template also has error - since using just Flask-WTF form based CSRF -
@@ -218,7 +204,7 @@ def test_reset(app, client):
 
         # test sending csrf_token works - JSON
         data["csrf_token"] = csrf_token
-        response = client.post("/reset", content_type="application/json", json=data)
+        response = client.post("/reset", json=data)
         assert response.status_code == 200
 
         # test sending csrf_token works - forms
@@ -236,14 +222,13 @@ def test_cp_reset(app, client):
     with mp_validate_csrf() as mp:
         data = dict(email="matt@lp.com")
         # should fail - no CSRF token
-        response = client.post("/reset", content_type="application/json", json=data)
+        response = client.post("/reset", json=data)
         assert response.status_code == 400
         assert response.json["response"]["errors"][0] == "The CSRF token is missing."
 
         csrf_token = _get_csrf_token(client)
         response = client.post(
             "/reset",
-            content_type="application/json",
             json=data,
             headers={"X-CSRF-Token": csrf_token},
         )
@@ -272,7 +257,6 @@ def test_cp_with_token(app, client):
     with mp_validate_csrf() as mp:
         response = client.post(
             "/change",
-            content_type="application/json",
             json=data,
             headers={"X-XSRF-Token": csrf_token},
         )
@@ -281,9 +265,9 @@ def test_cp_with_token(app, client):
     json_logout(client)
 
 
+@pytest.mark.app_settings(wtf_csrf_enabled=True)
 def test_cp_login_json_no_session(app, sqlalchemy_datastore):
     # Test with global CSRFProtect on and not sending cookie - nothing works.
-    app.config["WTF_CSRF_ENABLED"] = True
     CSRFProtect(app)
     app.security = Security(app=app, datastore=sqlalchemy_datastore)
 
@@ -294,7 +278,6 @@ def test_cp_login_json_no_session(app, sqlalchemy_datastore):
         data = dict(email="matt@lp.com", password="password", remember="y")
         response = client_nc.post(
             "/login",
-            content_type="application/json",
             json=data,
             headers={"Accept": "application/json"},
         )
@@ -303,7 +286,6 @@ def test_cp_login_json_no_session(app, sqlalchemy_datastore):
         # This still wont work since we don't send a session cookie
         response = client_nc.post(
             "/login",
-            content_type="application/json",
             json=data,
             headers={"X-CSRF-Token": _get_csrf_token(client_nc)},
         )
@@ -314,28 +296,22 @@ def test_cp_login_json_no_session(app, sqlalchemy_datastore):
 
 
 @pytest.mark.settings(CSRF_PROTECT_MECHANISMS=["basic", "session"])
+@pytest.mark.app_settings(wtf_csrf_enabled=True)
 def test_cp_config(app, sqlalchemy_datastore):
     # Test improper config (must have WTF_CSRF_CHECK_DEFAULT false if setting
     # CSRF_PROTECT_MECHANISMS
-    from flask_security import Security
-
-    app.config["WTF_CSRF_ENABLED"] = True
     CSRFProtect(app)
 
-    # The check is done on first request.
     with pytest.raises(ValueError) as ev:
         Security(app=app, datastore=sqlalchemy_datastore)
     assert "must be set to False" in str(ev.value)
 
 
 @pytest.mark.settings(CSRF_PROTECT_MECHANISMS=["basic", "session"])
+@pytest.mark.app_settings(wtf_csrf_enabled=True)
 def test_cp_config2(app, sqlalchemy_datastore):
     # Test improper config (must have CSRFProtect configured if setting
     # CSRF_PROTECT_MECHANISMS
-    from flask_security import Security
-
-    app.config["WTF_CSRF_ENABLED"] = True
-
     with pytest.raises(ValueError) as ev:
         Security(app=app, datastore=sqlalchemy_datastore)
     assert "CsrfProtect not part of application" in str(ev.value)
@@ -356,9 +332,7 @@ def test_different_mechanisms(app, client):
             new_password_confirm="battery staple",
         )
 
-        response = client.post(
-            "/change", json=data, headers={"Content-Type": "application/json"}
-        )
+        response = client.post("/change", json=data)
         assert response.status_code == 400
         assert b"The CSRF token is missing" in response.data
 
@@ -367,7 +341,6 @@ def test_different_mechanisms(app, client):
             "/change",
             json=data,
             headers={
-                "Content-Type": "application/json",
                 "Authentication-Token": auth_token,
             },
         )
@@ -400,7 +373,6 @@ def test_different_mechanisms_nc(app, client_nc):
             "/change",
             json=data,
             headers={
-                "Content-Type": "application/json",
                 "Authentication-Token": auth_token,
             },
         )
@@ -424,10 +396,8 @@ def test_cp_with_token_empty_mechanisms(app, client):
 
     response = client.post(
         "/change",
-        content_type="application/json",
         json=data,
         headers={
-            "Content-Type": "application/json",
             "Authentication-Token": auth_token,
         },
     )
@@ -449,9 +419,9 @@ def test_csrf_cookie(app, client):
 @pytest.mark.csrf(csrfprotect=True)
 @pytest.mark.settings(CSRF_COOKIE={"key": "XSRF-Token"})
 @pytest.mark.changeable()
-def test_cp_with_token_cookie(app, client):
+def test_cp_with_token_cookie(app, logged_in_client):
     # Make sure can use returned CSRF-Token cookie in Header when changing password
-    json_login(client, use_header=True)
+    client = logged_in_client
 
     # make sure returned csrf_token works in header.
     data = dict(
@@ -463,7 +433,6 @@ def test_cp_with_token_cookie(app, client):
     with mp_validate_csrf() as mp:
         response = client.post(
             "/change",
-            content_type="application/json",
             json=data,
             headers={"X-XSRF-Token": csrf_token.value},
         )
@@ -477,13 +446,17 @@ def test_cp_with_token_cookie(app, client):
 @pytest.mark.app_settings(wtf_csrf_time_limit=1)
 @pytest.mark.settings(CSRF_COOKIE_NAME="XSRF-Token", csrf_ignore_unauth_endpoints=True)
 @pytest.mark.changeable()
-def test_cp_with_token_cookie_expire(app, client):
+def test_cp_with_token_cookie_expire(app, client, monkeypatch):
     # Make sure that we get a new Csrf-Token cookie if expired.
-    # Note that we need relatively new-ish date since session cookies also expire.
-    with freeze_time(date.today() + timedelta(days=-1)):
+    # Only the itsdangerous signer clock (used for the CSRF token) needs to be
+    # in the past. Note that we need relatively new-ish date since session
+    # cookies (also signed) expire.
+    yesterday = int(time.time()) - 24 * 60 * 60
+    with monkeypatch.context() as m:
+        m.setattr(TimestampSigner, "get_timestamp", lambda self: yesterday)
         json_login(client, use_header=True)
 
-    # time unfrozen so should be expired
+    # back to real time so should be expired
     data = dict(
         password="password",
         new_password="battery staple",
@@ -493,7 +466,6 @@ def test_cp_with_token_cookie_expire(app, client):
     with mp_validate_csrf() as mp:
         response = client.post(
             "/change",
-            content_type="application/json",
             json=data,
             headers={"X-XSRF-Token": csrf_token.value},
         )
@@ -514,9 +486,9 @@ def test_cp_with_token_cookie_expire(app, client):
     CSRF_COOKIE_NAME="XSRF-Token", CSRF_COOKIE_REFRESH_EACH_REQUEST=True
 )
 @pytest.mark.changeable()
-def test_cp_with_token_cookie_refresh(app, client):
+def test_cp_with_token_cookie_refresh(app, logged_in_client):
     # Test CSRF_COOKIE_REFRESH_EACH_REQUEST
-    json_login(client, use_header=True)
+    client = logged_in_client
 
     # make sure returned csrf_token works in header.
     data = dict(
@@ -531,7 +503,6 @@ def test_cp_with_token_cookie_refresh(app, client):
         client.delete_cookie("XSRF-Token")
         response = client.post(
             "/change",
-            content_type="application/json",
             json=data,
             headers={"X-XSRF-Token": csrf_cookie.value},
         )
@@ -590,16 +561,14 @@ def test_json_register_csrf_with_ignore_unauth_set_to_false(app, client):
     email = "eg@testuser.com"
     data = {"email": email, "password": "password"}
 
-    response = client.post(
-        "/register", json=data, headers={"Content-Type": "application/json"}
-    )
+    response = client.post("/register", json=data)
     assert response.status_code == 400
     assert response.json["response"]["errors"][0] == "The CSRF token is missing."
 
     response = client.post(
         "/register",
         json=data,
-        headers={"Content-Type": "application/json", "X-CSRF-Token": csrf_token},
+        headers={"X-CSRF-Token": csrf_token},
     )
     assert response.status_code == 200
     assert response.json["response"]["user"]["email"] == email
@@ -653,7 +622,6 @@ def test_myform(app, client):
         "/custom",
         json={"name": "authtoken POST"},
         headers={
-            "Content-Type": "application/json",
             "Authentication-Token": auth_token,
         },
     )